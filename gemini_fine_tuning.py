@@ -17,16 +17,19 @@ import sys
 import os
 import json
 import time
+import atexit
 from pathlib import Path
 import logging
+import logging.handlers
+import queue
 
-from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
+from PyQt5.QtGui import QTextCursor
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QLabel, QLineEdit, QPushButton, QTextEdit, QFileDialog, QComboBox,
     QMessageBox
 )
-import google.generativeai as genai
 
 ###############################################################################
 # Rate Limiter (for tracking API usage)
@@ -39,65 +42,112 @@ class RateLimiter:
         'gemini-2.0-flash': {'rpm': 10, 'daily': 1500},
         'gemini-2.0-flash-thinking': {'rpm': 10, 'daily': 1500},
     }
+    # State is buffered in memory and flushed every N requests or T seconds.
+    FLUSH_EVERY_N = 20
+    FLUSH_INTERVAL = 5.0
     
     def __init__(self):
         self.log_file = Path('rate_limits.log')
         self.state_file = Path('rate_state.json')
+        self._dirty_count = 0
+        self._last_flush = time.time()
         self.setup_logging()
         self.load_state()
+        atexit.register(self.save_state)
         
     def setup_logging(self):
-        logging.basicConfig(
-            filename=self.log_file,
-            level=logging.INFO,
-            format='%(asctime)s - %(message)s',
+        # Records are queued from the caller and written to disk by a
+        # background listener thread, so log_request never blocks on I/O.
+        self.logger = logging.getLogger('ratelimit')
+        if self.logger.handlers:
+            # The logger is process-global; another RateLimiter already set it up.
+            return
+        file_handler = logging.FileHandler(self.log_file)
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(message)s',
             datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        ))
+        log_queue = queue.Queue(-1)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self.log_listener.start()
+        atexit.register(self.log_listener.stop)
         
     def load_state(self):
         if self.state_file.exists():
             with open(self.state_file, 'r') as f:
                 self.state = json.load(f)
+            now = time.time()
+            migrated = False
+            for model in self.MODELS:
+                model_state = self.state.get(model)
+                if model_state is None:
+                    self.state[model] = self._new_model_state(now)
+                    migrated = True
+                elif 'minute_bucket' not in model_state:
+                    if 'minute_start' in model_state and 'day_start' in model_state:
+                        # Convert the older timestamp-based schema, keeping the counts.
+                        model_state['minute_bucket'] = int(model_state.pop('minute_start') // 60)
+                        model_state['day_bucket'] = int(model_state.pop('day_start') // 86400)
+                    else:
+                        # Neither schema (e.g. a hand-edited file); start fresh.
+                        self.state[model] = self._new_model_state(now)
+                    migrated = True
+            if migrated:
+                self.save_state()
         else:
             self.state = self._initialize_state()
             self.save_state()
             
     def _initialize_state(self):
+        now = time.time()
+        return {model: self._new_model_state(now) for model in self.MODELS}
+
+    @staticmethod
+    def _new_model_state(now):
+        # Windows are tracked as integer minute/day buckets since the epoch.
         return {
-            model: {
-                'minute_start': time.time(),
-                'day_start': time.time(),
-                'minute_requests': 0,
-                'daily_requests': 0
-            }
-            for model in self.MODELS
+            'minute_bucket': int(now // 60),
+            'day_bucket': int(now // 86400),
+            'minute_requests': 0,
+            'daily_requests': 0
         }
         
     def save_state(self):
-        with open(self.state_file, 'w') as f:
-            json.dump(self.state, f)
+        # Write to a sibling temp file and swap it in so a crash mid-write
+        # never leaves a truncated state file behind.
+        tmp = self.state_file.with_suffix('.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, separators=(',', ':'))
+        os.replace(tmp, self.state_file)
+        self._dirty_count = 0
+        self._last_flush = time.time()
             
     def log_request(self, model):
         # Advisory only; never block the call.
         if model not in self.MODELS:
-            logging.error(f"Unknown model: {model}")
+            self.logger.error(f"Unknown model: {model}")
             return True
             
         current_time = time.time()
+        minute_bucket = int(current_time // 60)
+        day_bucket = int(current_time // 86400)
         model_state = self.state[model]
         limits = self.MODELS[model]
         
-        if current_time - model_state['minute_start'] >= 60:
-            model_state['minute_start'] = current_time
+        if model_state['minute_bucket'] != minute_bucket:
+            model_state['minute_bucket'] = minute_bucket
             model_state['minute_requests'] = 0
             
-        if current_time - model_state['day_start'] >= 86400:
-            model_state['day_start'] = current_time
+        if model_state['day_bucket'] != day_bucket:
+            model_state['day_bucket'] = day_bucket
             model_state['daily_requests'] = 0
             
         if (model_state['minute_requests'] >= limits['rpm'] or 
             model_state['daily_requests'] >= limits['daily']):
-            logging.warning(
+            self.logger.warning(
                 f"{model} - Rate limit advisory: "
                 f"{limits['rpm'] - model_state['minute_requests']} requests remaining this minute, "
                 f"{limits['daily'] - model_state['daily_requests']} requests remaining today."
@@ -106,30 +156,75 @@ class RateLimiter:
         model_state['daily_requests'] += 1
         remaining_minute = limits['rpm'] - model_state['minute_requests']
         remaining_daily = limits['daily'] - model_state['daily_requests']
-        logging.info(
+        self.logger.info(
             f"{model} - Request logged. Remaining: {remaining_minute}/min, {remaining_daily}/day"
         )
-        self.save_state()
+        self._dirty_count += 1
+        if (self._dirty_count >= self.FLUSH_EVERY_N or
+                current_time - self._last_flush > self.FLUSH_INTERVAL):
+            self.save_state()
         return True  # Always allow the call
 
-    def get_limits(self):
+    def get_limits_for(self, model):
+        if model not in self.MODELS:
+            return None
         current_time = time.time()
-        status = {}
-        for model, state in self.state.items():
-            limits = self.MODELS[model]
-            remaining_minute = limits['rpm'] - state['minute_requests']
-            remaining_daily = limits['daily'] - state['daily_requests']
-            
-            if current_time - state['minute_start'] >= 60:
-                remaining_minute = limits['rpm']
-            if current_time - state['day_start'] >= 86400:
-                remaining_daily = limits['daily']
-                
-            status[model] = {
-                'remaining_minute': remaining_minute,
-                'remaining_daily': remaining_daily
-            }
-        return status
+        state = self.state[model]
+        limits = self.MODELS[model]
+        minute_expired = state['minute_bucket'] != int(current_time // 60)
+        day_expired = state['day_bucket'] != int(current_time // 86400)
+        return {
+            'remaining_minute': limits['rpm'] if minute_expired
+                                else limits['rpm'] - state['minute_requests'],
+            'remaining_daily': limits['daily'] if day_expired
+                               else limits['daily'] - state['daily_requests']
+        }
+
+###############################################################################
+# Prompt templates (built once at import; only the variable fields are filled)
+###############################################################################
+_FEW_SHOT_EXAMPLES = (
+    "Example Manual Excerpt:\n"
+    "Machine: CNC Lathe\n"
+    "Part: Main Spindle, part number 1234567, operates at 2000 RPM, requires lubrication every 500 hours.\n\n"
+    "Expected Output (Fine-Tuning Dataset Entry):\n"
+    "[\n"
+    "  {\n"
+    '    "instruction": "For CNC Lathe, what is the part number for the Main Spindle?",\n'
+    '    "context": "Industrial environment",\n'
+    '    "response": "1234567",\n'
+    '    "category": "Spindle"\n'
+    "  },\n"
+    "  {\n"
+    '    "instruction": "For CNC Lathe, what are the operational details of the Main Spindle?",\n'
+    '    "context": "Industrial environment",\n'
+    '    "response": "Operates at 2000 RPM and requires lubrication every 500 hours.",\n'
+    '    "category": "Spindle"\n'
+    "  }\n"
+    "]\n"
+)
+
+_QA_PROMPT_TEMPLATE = (
+    "The user provided the following additional Q&A examples for reference (do NOT repeat these exactly):\n"
+    "{qa}\n\n"
+    "Based on these reference examples, generate new and distinct questions and answers. Do not duplicate any of the provided examples. "
+    "Ensure your generated dataset covers any details or parts not already addressed by the examples.\n\n"
+)
+
+_PROMPT_TEMPLATE = (
+    "You are an expert at reading technical manuals and creating fine-tuning datasets in the Dolly format. "
+    "Your task is to extract every detail from the manual provided below. For each part mentioned, generate at least one new question that includes "
+    "the machine name (as specified) and asks for the part number, along with additional questions covering operational or descriptive details. "
+    "Do NOT repeat any questions or answers already provided in the reference examples. Instead, produce new and unique fine-tuning dataset entries that cover any missing details. "
+    "Your output must be a JSON array where each element is an object with the following keys: 'instruction', 'context', 'response', and 'category'.\n\n"
+    "{context_instruction}\n"
+    "{few_shot}\n"
+    "{qa}"
+    "Machine Name: {machine}\n\n"
+    "Manual Text:\n"
+    "{input}\n\n"
+    "Make sure that every generated question includes the machine name and that the 'context' and 'category' fields are populated appropriately."
+)
 
 ###############################################################################
 # Gemini Worker (modified for Dolly format with context and category)
@@ -138,7 +233,7 @@ class GeminiOneShotWorker(QThread):
     progress_msg = pyqtSignal(str)
     finished = pyqtSignal(str)
 
-    def __init__(self, text, model_name, generation_config, machine_name, context, category, additional_qa, parent=None):
+    def __init__(self, text, model_name, generation_config, machine_name, context, category, additional_qa, api_key, parent=None):
         super().__init__(parent)
         self.text = text
         self.model_name = model_name
@@ -147,9 +242,15 @@ class GeminiOneShotWorker(QThread):
         self.context = context
         self.category = category
         self.additional_qa = additional_qa
+        self.api_key = api_key
 
     def run(self):
         try:
+            # Imported and configured here, off the GUI thread: the SDK pulls
+            # in grpc/protobuf and is slow to load.
+            import google.generativeai as genai
+            genai.configure(api_key=self.api_key)
+
             self.update_log(f"Initializing Gemini model: {self.model_name}")
             model = genai.GenerativeModel(
                 model_name=self.model_name,
@@ -175,35 +276,7 @@ class GeminiOneShotWorker(QThread):
             self.finished.emit(error_msg)
 
     def build_prompt(self, input_text, machine_name, context, category, additional_qa):
-        few_shot_examples = (
-            "Example Manual Excerpt:\n"
-            "Machine: CNC Lathe\n"
-            "Part: Main Spindle, part number 1234567, operates at 2000 RPM, requires lubrication every 500 hours.\n\n"
-            "Expected Output (Fine-Tuning Dataset Entry):\n"
-            "[\n"
-            "  {\n"
-            '    "instruction": "For CNC Lathe, what is the part number for the Main Spindle?",\n'
-            '    "context": "Industrial environment",\n'
-            '    "response": "1234567",\n'
-            '    "category": "Spindle"\n'
-            "  },\n"
-            "  {\n"
-            '    "instruction": "For CNC Lathe, what are the operational details of the Main Spindle?",\n'
-            '    "context": "Industrial environment",\n'
-            '    "response": "Operates at 2000 RPM and requires lubrication every 500 hours.",\n'
-            '    "category": "Spindle"\n'
-            "  }\n"
-            "]\n"
-        )
-        
-        qa_prompt = ""
-        if additional_qa:
-            qa_prompt = (
-                "The user provided the following additional Q&A examples for reference (do NOT repeat these exactly):\n"
-                f"{additional_qa}\n\n"
-                "Based on these reference examples, generate new and distinct questions and answers. Do not duplicate any of the provided examples. "
-                "Ensure your generated dataset covers any details or parts not already addressed by the examples.\n\n"
-            )
+        qa_prompt = _QA_PROMPT_TEMPLATE.format(qa=additional_qa) if additional_qa else ""
     
         # If either context or category is empty, instruct the model to deduce them from the text.
         if context.strip() == "" or category.strip() == "":
@@ -211,25 +284,28 @@ class GeminiOneShotWorker(QThread):
         else:
             context_instruction = f"Use the following values for all entries:\n   Context: {context}\n   Category: {category}\n\n"
 
-        prompt = (
-            "You are an expert at reading technical manuals and creating fine-tuning datasets in the Dolly format. "
-            "Your task is to extract every detail from the manual provided below. For each part mentioned, generate at least one new question that includes "
-            "the machine name (as specified) and asks for the part number, along with additional questions covering operational or descriptive details. "
-            "Do NOT repeat any questions or answers already provided in the reference examples. Instead, produce new and unique fine-tuning dataset entries that cover any missing details. "
-            "Your output must be a JSON array where each element is an object with the following keys: 'instruction', 'context', 'response', and 'category'.\n\n"
-            + context_instruction + "\n"
-            + few_shot_examples + "\n"
-            + qa_prompt +
-            f"Machine Name: {machine_name}\n\n"
-            "Manual Text:\n"
-            f"{input_text}\n\n"
-            "Make sure that every generated question includes the machine name and that the 'context' and 'category' fields are populated appropriately."
+        return _PROMPT_TEMPLATE.format(
+            context_instruction=context_instruction,
+            few_shot=_FEW_SHOT_EXAMPLES,
+            qa=qa_prompt,
+            machine=machine_name,
+            input=input_text
         )
-        return prompt
+
+    def strip_code_fence(self, raw_text):
+        raw = raw_text.strip()
+        # Models often wrap JSON in a markdown code fence (```json ... ```).
+        if raw.startswith("```"):
+            raw = raw.partition("\n")[2].rsplit("```", 1)[0].strip()
+        return raw
 
     def parse_response(self, raw_text):
+        raw = self.strip_code_fence(raw_text)
+        # The dataset is always a JSON array or object; skip parsing anything else.
+        if not raw.startswith(("[", "{")):
+            return raw_text
         try:
-            return json.loads(raw_text)
+            return json.loads(raw)
         except json.JSONDecodeError:
             # If the raw text is not valid JSON, return it as-is.
             return raw_text
@@ -352,15 +428,22 @@ class GeminiDollyDatasetCreatorApp(QMainWindow):
         log_layout.addWidget(self.log_edit)
         layout.addLayout(log_layout)
 
+        # Log messages are buffered and appended in one go every 100 ms so
+        # bursts of worker output trigger a single relayout.
+        self._log_buf = []
+        self._log_timer = QTimer(self)
+        self._log_timer.setSingleShot(True)
+        self._log_timer.setInterval(100)
+        self._log_timer.timeout.connect(self._flush_logs)
+
         self.init_gemini_api()
         self.init_rate_limiter()
         self.worker = None
 
     def init_gemini_api(self):
+        # Only check the key here; the worker imports and configures the SDK.
         try:
-            api_key = os.environ["GEMINI_API_KEY"]
-            genai.configure(api_key=api_key)
-            self.log("Gemini API configured successfully.")
+            self.api_key = os.environ["GEMINI_API_KEY"]
         except KeyError:
             self.log("Error: GEMINI_API_KEY environment variable not set.")
             QMessageBox.critical(self, "API Key Error", 
@@ -372,10 +455,9 @@ class GeminiDollyDatasetCreatorApp(QMainWindow):
         self.update_limits_display()
 
     def update_limits_display(self):
-        limits = self.rate_limiter.get_limits()
         current_model = self.model_combo.currentText()
-        if current_model in limits:
-            status = limits[current_model]
+        status = self.rate_limiter.get_limits_for(current_model)
+        if status is not None:
             self.log(f"Current limits for {current_model}:")
             self.log(f"Remaining requests per minute: {status['remaining_minute']}")
             self.log(f"Remaining requests per day: {status['remaining_daily']}")
@@ -450,7 +532,8 @@ class GeminiDollyDatasetCreatorApp(QMainWindow):
             machine_name=machine_name,
             context=context,
             category=category,
-            additional_qa=additional_qa
+            additional_qa=additional_qa,
+            api_key=self.api_key
         )
         self.worker.progress_msg.connect(self.log)
         self.worker.finished.connect(self.display_response)
@@ -486,7 +569,31 @@ class GeminiDollyDatasetCreatorApp(QMainWindow):
                 QMessageBox.warning(self, "Save Error", f"Failed to save response: {str(e)}")
 
     def log(self, message):
-        self.log_edit.append(message)
+        self._log_buf.append(message)
+        if not self._log_timer.isActive():
+            self._log_timer.start()
+
+    def _flush_logs(self):
+        if not self._log_buf:
+            return
+        scrollbar = self.log_edit.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        document = self.log_edit.document()
+        cursor = QTextCursor(document)
+        cursor.movePosition(QTextCursor.End)
+        # One edit block means one relayout; each message is inserted as
+        # plain text in its own paragraph, like QTextEdit.append would.
+        cursor.beginEditBlock()
+        needs_break = not document.isEmpty()
+        for message in self._log_buf:
+            if needs_break:
+                cursor.insertBlock()
+            cursor.insertText(message)
+            needs_break = True
+        cursor.endEditBlock()
+        self._log_buf.clear()
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
 ###############################################################################
 # Main entry point